@@ -0,0 +1,49 @@
+"""
+Micro-benchmark for the per-roll cost of building the seed/create request body.
+
+Compares serializing preset settings on every roll (the old behaviour) with
+sending the body pre-serialized by ZSR.encode_settings at load time.
+
+Usage: python benchmarks/bench_payload.py [presets_default.json]
+"""
+import json
+import sys
+import timeit
+
+from randobot.zsr import ZSR
+
+
+def synthetic_settings():
+    return {
+        'setting_%d' % i: (
+            ['item_%d' % j for j in range(20)] if i % 5 == 0
+            else i % 2 == 0 if i % 3 == 0
+            else 'value_%d' % i
+        )
+        for i in range(300)
+    }
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], encoding='utf-8') as f:
+            presets = json.load(f)
+        settings = next(iter(presets.values()))
+    else:
+        settings = synthetic_settings()
+
+    zsr = ZSR('benchmark')
+    body = zsr.encode_settings(settings)
+    presets = {'weekly': {'settings': settings, 'body': body}}
+    number = 10000
+
+    before = timeit.timeit(lambda: json.dumps(presets['weekly']['settings']), number=number)
+    after = timeit.timeit(lambda: presets['weekly']['body'], number=number)
+
+    print('payload size: %d bytes' % len(body))
+    print('json.dumps per roll:     %8.2f us' % (before / number * 1e6))
+    print('pre-serialized per roll: %8.2f us' % (after / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
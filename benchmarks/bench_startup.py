@@ -0,0 +1,128 @@
+"""
+Startup benchmark: how long until a freshly started RandoBot can serve a room.
+
+Reports the slowest imports (from `python -X importtime`) and, against a local
+fake ootrandomizer.com, the time from process start until the first race room
+gets its welcome message, without a cache directory and with a cold and a
+warm one.
+Each measurement runs in a new interpreter so imports are cold.
+
+Usage: python benchmarks/bench_startup.py [--top 15] [--latency 0.1]
+"""
+import time
+
+STARTED = time.perf_counter()
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import json  # noqa: E402
+import logging  # noqa: E402
+import os  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_times(module):
+    """
+    Return (module, self µs, cumulative µs) for every module imported by
+    `import module` in a new interpreter.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        stderr=subprocess.PIPE, universal_newlines=True, check=True,
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times.append((name.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+
+async def first_room(zsr_url, cache_dir):
+    """
+    Child process: start up like the bot does and handle one room until it
+    sends its first message. Prints timings as JSON.
+    """
+    sys.path.insert(0, HERE)
+    from randobot.bot import RandoBot  # noqa: F401 (the bot's own import cost)
+    from randobot.handler import RandoHandler
+    from randobot.midos_house import MidosHouse
+    from randobot.poller import StatusPoller
+    from fake_services import FakeRaceRoom, local_zsr_class
+    imported = time.perf_counter()
+
+    logger = logging.getLogger('bench_startup')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    zsr = local_zsr_class(zsr_url)('bench', cache_dir=cache_dir or None)
+    zsr.create_branches()
+    room = FakeRaceRoom('ootr/bench-startup')
+    handler = RandoHandler(
+        zsr=zsr,
+        midos_house=MidosHouse(cache_dir=cache_dir or None),
+        status_poller=StatusPoller(zsr, logger),
+        state_store=None,
+        seed_pool=None,
+        logger=logger,
+        conn=room,
+        state={},
+    )
+    handler.data = dict(room.data)
+    task = asyncio.ensure_future(handler.handle())
+    await room.wait_for(lambda data: data['action'] == 'message', 60)
+    ready = time.perf_counter()
+    room.close()
+    await task
+    await zsr.close()
+    print(json.dumps({'import': imported - STARTED, 'first_room': ready - STARTED}))
+
+
+async def measure(zsr_url, cache_dir):
+    started = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), '--child', zsr_url, cache_dir,
+        stdout=asyncio.subprocess.PIPE,
+    )
+    stdout, _ = await proc.communicate()
+    result = json.loads(stdout.decode().strip().splitlines()[-1])
+    result['wall'] = time.perf_counter() - started
+    return result
+
+
+async def main(args):
+    sys.path.insert(0, HERE)
+    from fake_services import FakeZSRServer
+
+    times = import_times('randobot.bot')
+    total = next((cumulative for name, _, cumulative in times if name == 'randobot.bot'), 0)
+    print('import randobot.bot: %.1fms' % (total / 1000))
+    print('slowest imports (cumulative):')
+    top_level = sorted(times, key=lambda item: item[2], reverse=True)[:args.top]
+    for name, self_us, cumulative_us in top_level:
+        print('  %-40s %8.1fms (self %.1fms)' % (name, cumulative_us / 1000, self_us / 1000))
+
+    server = FakeZSRServer(latency=(args.latency, args.latency))
+    await server.start()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for label, directory in (('no cache', ''), ('cold cache', cache_dir), ('warm cache', cache_dir)):
+            result = await measure(server.url, directory)
+            print('%-11s imports %.0fms, first room %.0fms (%.0fms including interpreter start)' % (
+                label + ':', result['import'] * 1000, result['first_room'] * 1000, result['wall'] * 1000,
+            ))
+    await server.stop()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        asyncio.run(first_room(sys.argv[2], sys.argv[3]))
+        sys.exit()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--top', type=int, default=15, help='number of imports to list')
+    parser.add_argument('--latency', type=float, default=0.1, help='fake API response latency in seconds')
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,220 @@
+"""
+Local stand-ins for ootrandomizer.com and racetime.gg, for benchmarks and
+load tests.
+
+`FakeZSRServer` serves the ootrandomizer.com API endpoints RandoBot uses plus
+the preset JSON files, with configurable latency and failure rate.
+`FakeRaceRoom` is a websocket replacement that can be handed to a
+`RandoHandler` as its connection, so many handlers can be driven at once
+without a racetime.gg server.
+"""
+import asyncio
+import json
+import random
+import uuid
+
+from aiohttp import web
+
+from randobot.zsr import ZSR
+
+
+def local_zsr_class(url):
+    """
+    A ZSR subclass pointing at a FakeZSRServer running at `url`.
+    """
+    class LocalZSR(ZSR):
+        seed_public = url + '/seed/get?id=%(id)s'
+        seed_endpoint = url + '/api/v2/seed/create'
+        status_endpoint = url + '/api/v2/seed/status'
+        details_endpoint = url + '/api/v2/seed/details'
+        password_endpoint = url + '/api/v2/seed/pw'
+        version_endpoint = url + '/api/version'
+        valid_versions = tuple(
+            (rtgg_arg, name, ootr_name, url + '/presets/%s.json' % rtgg_arg)
+            for rtgg_arg, name, ootr_name, _ in ZSR.valid_versions
+        )
+
+    return LocalZSR
+
+
+class FakeZSRServer:
+    def __init__(self, host='127.0.0.1', port=0, latency=(0.0, 0.0), failure_rate=0.0,
+                 generation_time=(1.0, 3.0), presets=None, version='8.0.0'):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.generation_time = generation_time
+        self.presets = presets or {
+            'Standard Weekly': {'aliases': ['weekly'], **{'setting_%d' % i: i for i in range(200)}},
+            'Tournament': {'aliases': ['tournament', 's8'], **{'setting_%d' % i: i for i in range(200)}},
+        }
+        self.version = version
+        self.seeds = {}
+        self.requests = {}
+        self.runner = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % (self.host, self.port)
+
+    def zsr_class(self):
+        """
+        A ZSR subclass pointing at this server instead of ootrandomizer.com.
+        """
+        return local_zsr_class(self.url)
+
+    async def start(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_post('/api/v2/seed/create', self.create)
+        app.router.add_get('/api/v2/seed/status', self.status)
+        app.router.add_get('/api/v2/seed/details', self.details)
+        app.router.add_get('/api/v2/seed/pw', self.password)
+        app.router.add_get('/api/version', self.get_version)
+        app.router.add_get('/presets/{branch}.json', self.get_presets)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        self.requests[request.path] = self.requests.get(request.path, 0) + 1
+        await asyncio.sleep(random.uniform(*self.latency))
+        if random.random() < self.failure_rate:
+            return web.Response(status=503)
+        return await handler(request)
+
+    async def create(self, request):
+        await request.read()
+        seed_id = len(self.seeds) + 1
+        loop = asyncio.get_running_loop()
+        self.seeds[seed_id] = {
+            'ready_at': loop.time() + random.uniform(*self.generation_time),
+            'password': request.query.get('passwordLock') == 'true',
+        }
+        return web.json_response({'id': seed_id})
+
+    def seed(self, request):
+        try:
+            return self.seeds[int(request.query['id'])]
+        except (KeyError, ValueError):
+            raise web.HTTPNotFound()
+
+    async def status(self, request):
+        ready = asyncio.get_running_loop().time() >= self.seed(request)['ready_at']
+        return web.json_response({'status': 1 if ready else 0})
+
+    async def details(self, request):
+        self.seed(request)
+        return web.json_response({
+            'id': int(request.query['id']),
+            'settingsLog': json.dumps({
+                ':version': self.version,
+                ':seed': uuid.uuid4().hex,
+                'file_hash': random.sample(list(ZSR.hash_map), 5),
+                'settings': {'setting_%d' % i: i for i in range(500)},
+            }, indent=4),
+        })
+
+    async def password(self, request):
+        self.seed(request)
+        return web.json_response({'pw': random.choices(list(ZSR.notes_map), k=6)})
+
+    async def get_version(self, request):
+        return web.json_response({'currentlyActiveVersion': self.version})
+
+    async def get_presets(self, request):
+        return web.json_response(self.presets)
+
+
+class FakeRaceRoom:
+    """
+    Fake racetime.gg race room websocket.
+
+    Use as the `conn` of a `RandoHandler`: `handle()` will read messages
+    pushed with `push_*` and everything the handler sends is recorded in
+    `sent`. Chat messages sent by the bot are echoed back like racetime.gg
+    does.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.data = {
+            'name': name,
+            'status': {'value': 'open'},
+            'goal': {'name': 'Random settings', 'custom': False},
+            'opened_by': {'name': 'runner'},
+            'info_bot': None,
+        }
+        self.sent = []
+        self.incoming = asyncio.Queue()
+        self.waiters = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.incoming.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def send(self, data):
+        data = json.loads(data)
+        self.sent.append(data)
+        if data['action'] == 'setinfo':
+            self.data['info_bot'] = data['data']['info_bot']
+        elif data['action'] == 'message':
+            self.push({'type': 'chat.message', 'message': {
+                'id': uuid.uuid4().hex,
+                'is_bot': True,
+                'bot': 'RandoBot',
+                'is_pinned': data['data'].get('pinned'),
+                'message': data['data']['message'],
+                'message_plain': data['data']['message'],
+            }})
+        for condition, future in list(self.waiters):
+            if not future.done() and condition(data):
+                future.set_result(data)
+
+    def push(self, message):
+        self.incoming.put_nowait(json.dumps(message))
+
+    def push_chat(self, text, user='runner', monitor=False):
+        self.push({'type': 'chat.message', 'message': {
+            'id': uuid.uuid4().hex,
+            'user': {'name': user, 'can_moderate': False},
+            'is_monitor': monitor,
+            'message': text,
+            'message_plain': text,
+            'is_bot': False,
+            'is_system': False,
+        }})
+
+    def push_status(self, status):
+        self.data['status'] = {'value': status}
+        self.push({'type': 'race.data', 'race': dict(self.data)})
+
+    def close(self):
+        self.incoming.put_nowait(None)
+
+    async def wait_for(self, condition, timeout=None):
+        """
+        Wait until the handler sends something matching `condition`.
+        """
+        for data in self.sent:
+            if condition(data):
+                return data
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((condition, future))
+        return await asyncio.wait_for(future, timeout)
@@ -0,0 +1,146 @@
+"""
+Load test for RandoBot's race handlers against local fake services.
+
+Opens many race rooms at once, has each one roll a seed with `!seed`, and
+reports room throughput, roll latency percentiles (from `!seed` to the seed
+hash appearing in the race info), event loop lag and the number of requests
+the fake ootrandomizer.com received.
+
+Usage: python benchmarks/load_test.py --rooms 200 --latency 0.05 0.3
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_services import FakeRaceRoom, FakeZSRServer  # noqa: E402
+
+from randobot.handler import RandoHandler  # noqa: E402
+from randobot.midos_house import MidosHouse  # noqa: E402
+from randobot.poller import StatusPoller  # noqa: E402
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+class LoopLagMonitor:
+    """
+    Measures how late a periodic timer fires, i.e. how long the event loop
+    was blocked.
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        self._task.cancel()
+
+
+async def run_room(index, zsr, midos_house, status_poller, logger, preset, timeout):
+    room = FakeRaceRoom('ootr/load-test-%d' % index)
+    handler = RandoHandler(
+        zsr=zsr,
+        midos_house=midos_house,
+        status_poller=status_poller,
+        state_store=None,
+        seed_pool=None,
+        logger=logger,
+        conn=room,
+        state={},
+    )
+    handler.data = dict(room.data)
+    task = asyncio.ensure_future(handler.handle())
+    await room.wait_for(lambda data: data['action'] == 'message', timeout)
+
+    started = time.perf_counter()
+    room.push_chat('!seed %s' % preset)
+    try:
+        await room.wait_for(
+            lambda data: data['action'] == 'setinfo' and '\n' in data['data']['info_bot'],
+            timeout,
+        )
+        latency = time.perf_counter() - started
+    except asyncio.TimeoutError:
+        latency = None
+    room.push_status('cancelled')
+    room.close()
+    await task
+    return latency
+
+
+async def main(args):
+    logger = logging.getLogger('load_test')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    server = FakeZSRServer(
+        latency=tuple(args.latency),
+        failure_rate=args.failure_rate,
+        generation_time=tuple(args.generation_time),
+    )
+    await server.start()
+    zsr = server.zsr_class()('load-test')
+    await zsr.build_version_map()
+    status_poller = StatusPoller(zsr, logger)
+    midos_house = MidosHouse()
+
+    lag_monitor = LoopLagMonitor()
+    lag_monitor.start()
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*(
+        run_room(i, zsr, midos_house, status_poller, logger, args.preset, args.timeout)
+        for i in range(args.rooms)
+    ))
+    elapsed = time.perf_counter() - started
+    lag_monitor.stop()
+
+    await zsr.close()
+    await server.stop()
+
+    succeeded = [latency for latency in latencies if latency is not None]
+    print('rooms:            %d (%d rolled, %d failed)' % (args.rooms, len(succeeded), args.rooms - len(succeeded)))
+    print('elapsed:          %.2fs (%.1f rooms/s)' % (elapsed, args.rooms / elapsed))
+    print('roll latency:     p50 %.2fs  p95 %.2fs  p99 %.2fs  max %.2fs' % (
+        percentile(succeeded, 50), percentile(succeeded, 95), percentile(succeeded, 99),
+        max(succeeded, default=float('nan')),
+    ))
+    print('event loop lag:   p50 %.1fms  p99 %.1fms  max %.1fms' % (
+        percentile(lag_monitor.lags, 50) * 1000, percentile(lag_monitor.lags, 99) * 1000,
+        max(lag_monitor.lags, default=0) * 1000,
+    ))
+    print('requests to fake ootrandomizer.com:')
+    for path, count in sorted(server.requests.items()):
+        print('  %-28s %d' % (path, count))
+    return 0 if len(succeeded) == args.rooms else 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rooms', type=int, default=50, help='number of race rooms to open at once')
+    parser.add_argument('--preset', type=str, default='weekly', help='preset to roll in each room')
+    parser.add_argument('--latency', type=float, nargs=2, default=(0.02, 0.2), metavar=('MIN', 'MAX'),
+                        help='fake API response latency range in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of fake API requests answered with 503')
+    parser.add_argument('--generation-time', type=float, nargs=2, default=(1.0, 5.0), metavar=('MIN', 'MAX'),
+                        help='fake seed generation time range in seconds')
+    parser.add_argument('--timeout', type=float, default=240, help='seconds to wait for each room')
+    sys.exit(asyncio.run(main(parser.parse_args())))
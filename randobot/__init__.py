@@ -1,8 +1,7 @@
 import argparse
 import logging
-import sys
 
-from .bot import RandoBot
+from .utils import default_cache_dir, default_state_db
 
 
 def main():
@@ -13,23 +12,31 @@ def main():
     parser.add_argument('category_slug', type=str, help='racetime.gg category')
     parser.add_argument('client_id', type=str, help='racetime.gg client ID')
     parser.add_argument('client_secret', type=str, help='racetime.gg client secret')
+    parser.add_argument('--also', type=str, nargs=3, action='append', default=[], metavar=('CATEGORY_SLUG', 'CLIENT_ID', 'CLIENT_SECRET'), help='also serve this racetime.gg category from the same process (may be repeated)')
     parser.add_argument('--verbose', '-v', action='store_true', help='verbose output')
     parser.add_argument('--host', type=str, nargs='?', help='change the ractime.gg host (debug only!')
+    parser.add_argument('--cache-dir', type=str, default=default_cache_dir(), help='directory for cached presets and versions (empty string to disable)')
+    parser.add_argument('--version-ttl', type=int, default=300, help='seconds between dev branch version checks')
+    parser.add_argument('--state-db', type=str, default=default_state_db(), help='SQLite file to persist race room state across restarts (empty string to disable)')
+    parser.add_argument('--pool-preset', type=str, action='append', default=[], metavar='[BRANCH:]PRESET[+spoiler][+password]', help='keep pre-generated seeds ready for this preset (may be repeated)')
+    parser.add_argument('--pool-size', type=int, default=2, help='number of pre-generated seeds to keep per pooled preset')
+    parser.add_argument('--pool-ttl', type=int, default=60 * 60 * 6, help='seconds before an unused pre-generated seed is discarded')
+    parser.add_argument('--pool-keep-on-version-bump', action='store_true', help='don\'t discard pre-generated seeds when their branch gets a new version')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on this port at /metrics (localhost only)')
+    parser.add_argument('--metrics-log-interval', type=int, help='log a line of metrics as JSON every this many seconds')
+    parser.add_argument('--log-json', action='store_true', help='log one JSON object per line')
     parser.add_argument('--insecure', action='store_true', help='don\'t use HTTPS (debug only!)')
 
     args = parser.parse_args()
 
-    logger = logging.getLogger()
-    handler = logging.StreamHandler(sys.stdout)
-
-    if args.verbose:
-        logger.setLevel(logging.DEBUG)
-        handler.setLevel(logging.DEBUG)
+    # Imported here so that --help and argument errors don't pay for
+    # loading racetime_bot, aiohttp and friends.
+    from .bot import RandoBot, run_all
+    from .log import setup_logging
+    from .seed_pool import SeedPool
 
-    handler.setFormatter(logging.Formatter(
-        '[%(asctime)s] %(name)s (%(levelname)s) :: %(message)s'
-    ))
-    logger.addHandler(handler)
+    logger = logging.getLogger()
+    setup_logging(logger, verbose=args.verbose, json_output=args.log_json)
 
     if args.host:
         RandoBot.racetime_host = args.host
@@ -42,8 +49,31 @@ def main():
         client_id=args.client_id,
         client_secret=args.client_secret,
         logger=logger,
+        cache_dir=args.cache_dir,
+        version_ttl=args.version_ttl,
+        state_db=args.state_db,
+        pool_keys=[SeedPool.parse_key(spec) for spec in args.pool_preset],
+        pool_size=args.pool_size,
+        pool_ttl=args.pool_ttl,
+        pool_invalidate_on_version_bump=not args.pool_keep_on_version_bump,
+        metrics_port=args.metrics_port,
+        metrics_log_interval=args.metrics_log_interval,
     )
-    inst.run()
+    if not args.also:
+        inst.run()
+        return
+    others = [
+        RandoBot(
+            ootr_api_key=args.ootr_api_key,
+            category_slug=category_slug,
+            client_id=client_id,
+            client_secret=client_secret,
+            logger=logger,
+            share_with=inst,
+        )
+        for category_slug, client_id, client_secret in args.also
+    ]
+    run_all([inst, *others])
 
 
 if __name__ == '__main__':
@@ -1,18 +1,85 @@
+import asyncio
+import logging
+import os
+import sqlite3
+
 from racetime_bot import Bot
 
 from .handler import RandoHandler
+from .metrics import metrics
 from .midos_house import MidosHouse
+from .poller import StatusPoller
+from .seed_pool import SeedPool
+from .store import StateStore
 from .zsr import ZSR
 
 
 class RandoBot(Bot):
     """
     RandoBot base class.
+
+    Several RandoBots can serve different categories from one process: pass
+    the first one as `share_with` to the others, and they will use its ZSR
+    client, caches, status poller, state store and seed pool instead of
+    creating their own. See `run_all`.
     """
-    def __init__(self, ootr_api_key, *args, **kwargs):
+    refresh_branches_every = 60 * 60
+
+    def __init__(self, ootr_api_key, *args, cache_dir=None, version_ttl=300, state_db=None,
+                 pool_keys=(), pool_size=2, pool_ttl=60 * 60 * 6, pool_invalidate_on_version_bump=True,
+                 metrics_port=None, metrics_log_interval=None, share_with=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.zsr = ZSR(ootr_api_key)
-        self.midos_house = MidosHouse()
+        self.owns_services = share_with is None
+        if share_with is not None:
+            self.zsr = share_with.zsr
+            self.midos_house = share_with.midos_house
+            self.status_poller = share_with.status_poller
+            self.state_store = share_with.state_store
+            self.seed_pool = share_with.seed_pool
+            return
+        self.metrics_port = metrics_port
+        self.metrics_log_interval = metrics_log_interval
+        metrics.enabled = bool(metrics_port or metrics_log_interval)
+        # The cache and state database only save work across restarts, so
+        # the bot can do without them (e.g. when HOME isn't writable).
+        if cache_dir:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+            except OSError:
+                self.logger.warning('Could not create cache directory %s, running without a cache.' % cache_dir, exc_info=True)
+                cache_dir = None
+        self.zsr = ZSR(ootr_api_key, cache_dir=cache_dir, version_ttl=version_ttl)
+        # The stable branch is loaded in the background once the bot is
+        # running (see load_stable), so startup doesn't wait on
+        # ootrandomizer.com.
+        self.zsr.create_branches()
+        self.midos_house = MidosHouse(cache_dir=cache_dir)
+        self.status_poller = StatusPoller(self.zsr, self.logger)
+        self.state_store = None
+        if state_db:
+            try:
+                self.state_store = StateStore(state_db)
+            except (OSError, sqlite3.Error):
+                self.logger.warning('Could not open state database %s, running without it.' % state_db, exc_info=True)
+        self.seed_pool = SeedPool(
+            self.zsr, self.status_poller, self.logger, pool_keys,
+            size=pool_size,
+            ttl=pool_ttl,
+            invalidate_on_version_bump=pool_invalidate_on_version_bump,
+        ) if pool_keys else None
+
+    async def load_stable(self):
+        if not await self.zsr.version_map['stable'].ensure_loaded():
+            self.logger.warning('Could not load the stable branch, will retry when needed.')
+
+    async def refresh_branches(self):
+        """
+        Periodically reload presets for every loaded branch in the background.
+        """
+        while True:
+            await asyncio.sleep(self.refresh_branches_every)
+            self.logger.info('Refresh branches')
+            await self.zsr.refresh_branches()
 
     def get_handler_class(self):
         return RandoHandler
@@ -22,4 +89,46 @@ class RandoBot(Bot):
             **super().get_handler_kwargs(*args, **kwargs),
             'zsr': self.zsr,
             'midos_house': self.midos_house,
+            'status_poller': self.status_poller,
+            'state_store': self.state_store,
+            'seed_pool': self.seed_pool,
         }
+
+    def start(self):
+        """
+        Schedule this bot's tasks on the event loop without running it.
+
+        Background tasks for the shared services are only started by the bot
+        that owns them.
+        """
+        if self.owns_services:
+            self.loop.create_task(self.load_stable())
+            self.loop.create_task(self.refresh_branches())
+            if self.seed_pool:
+                self.loop.create_task(self.seed_pool.run())
+            if metrics.enabled:
+                self.loop.create_task(metrics.monitor_loop_lag())
+            if self.metrics_port:
+                self.loop.create_task(metrics.serve(self.metrics_port))
+            if self.metrics_log_interval:
+                # Metrics lines are logged at INFO, which should be shown
+                # even when the rest of the bot only logs warnings.
+                metrics_logger = logging.getLogger('randobot.metrics')
+                metrics_logger.setLevel(logging.INFO)
+                self.loop.create_task(metrics.log_periodically(metrics_logger, self.metrics_log_interval))
+        self.loop.create_task(self.reauthorize())
+        self.loop.create_task(self.refresh_races())
+        self.loop.set_exception_handler(self.handle_exception)
+
+    def run(self):
+        self.start()
+        self.loop.run_forever()
+
+
+def run_all(bots):
+    """
+    Run several bots (sharing one event loop) until stopped.
+    """
+    for bot in bots:
+        bot.start()
+    asyncio.get_event_loop().run_forever()
@@ -0,0 +1,82 @@
+from collections import deque
+import time
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of making a request while its endpoint's circuit is open.
+    """
+    def __init__(self, endpoint, retry_in):
+        super().__init__('%s requests are suspended for %.0fs after repeated failures' % (endpoint, retry_in))
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to an endpoint that keeps failing.
+
+    The outcomes of the last `window` requests are kept; a request counts as
+    failed if it raised a transient error or took longer than `slow_call`
+    seconds. Once at least `min_calls` outcomes are known and the failure
+    rate reaches `failure_threshold`, the circuit opens and requests fail
+    immediately with CircuitOpenError. After `reset_timeout` seconds a single
+    probe request is let through (half-open): if it succeeds the circuit
+    closes again, otherwise it stays open for another `reset_timeout`.
+    """
+    def __init__(self, endpoint, window=20, min_calls=5, failure_threshold=0.5, slow_call=10, reset_timeout=30):
+        self.endpoint = endpoint
+        self.min_calls = min_calls
+        self.failure_threshold = failure_threshold
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self.outcomes = deque(maxlen=window)
+        self.state = 'closed'
+        self.opened_at = None
+        self.probing = False
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError if a request may not be made right now.
+        """
+        if self.state == 'closed':
+            return
+        retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+        if self.state == 'open' and retry_in <= 0:
+            self.state = 'half_open'
+        if self.state == 'half_open' and not self.probing:
+            self.probing = True
+            return
+        raise CircuitOpenError(self.endpoint, max(0, retry_in))
+
+    def record(self, failed, duration=0):
+        failed = failed or duration > self.slow_call
+        if self.state == 'open':
+            return  # a request from before the circuit opened
+        if self.state == 'half_open':
+            self.probing = False
+            if failed:
+                self.open()
+            else:
+                self.state = 'closed'
+                self.outcomes.clear()
+            return
+        self.outcomes.append(failed)
+        if len(self.outcomes) >= self.min_calls and sum(self.outcomes) / len(self.outcomes) >= self.failure_threshold:
+            self.open()
+
+    def cancel_probe(self):
+        """
+        Let another request probe the endpoint if the current probe ended
+        without an outcome (e.g. it was cancelled).
+        """
+        self.probing = False
+
+    def open(self):
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+        self.outcomes.clear()
+
+    @property
+    def is_open(self):
+        return self.state != 'closed'
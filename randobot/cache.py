@@ -0,0 +1,109 @@
+import asyncio
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import tempfile
+
+from .log import detached_task
+
+
+class DiskCache:
+    """
+    Persistent on-disk cache of HTTP response bodies, keyed by URL and query
+    parameters.
+
+    Each entry keeps the ETag/Last-Modified headers it was served with so
+    the response can be revalidated with a conditional GET.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, url, params=None):
+        key = json.dumps([url, sorted((params or {}).items())])
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def get(self, url, params=None):
+        try:
+            with open(self.path(url, params), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, url, params, body, etag=None, last_modified=None):
+        """
+        Store a response body, replacing any existing entry atomically.
+        """
+        entry = {
+            'url': url,
+            'params': params,
+            'etag': etag,
+            'last_modified': last_modified,
+            'body': body,
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self.path(url, params))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+class AsyncLRUCache:
+    """
+    Bounded in-memory LRU cache whose entries expire after `ttl` seconds.
+
+    `get_or_fetch` deduplicates concurrent lookups of a missing key, so only
+    one call is made no matter how many coroutines ask for it at once.
+    """
+    def __init__(self, max_size=1024, ttl=60 * 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.in_flight = {}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= asyncio.get_running_loop().time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = asyncio.get_running_loop().time() + (self.ttl if ttl is None else ttl)
+        self.entries[key] = (expires_at, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def get_or_fetch(self, key, fetch, cache_if=None, ttl=None):
+        """
+        Return the cached value for `key`, or await `fetch()` to get it.
+
+        The result is only cached if `cache_if(value)` is true (or
+        `cache_if` is None).
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        if key not in self.in_flight:
+            self.in_flight[key] = detached_task(self._fetch(key, fetch, cache_if, ttl))
+        return await asyncio.shield(self.in_flight[key])
+
+    async def _fetch(self, key, fetch, cache_if, ttl):
+        try:
+            value = await fetch()
+        finally:
+            del self.in_flight[key]
+        if value is not None and (cache_if is None or cache_if(value)):
+            self.set(key, value, ttl)
+        return value
@@ -1,10 +1,16 @@
-from asyncio import sleep
+import asyncio
 from copy import deepcopy
 import datetime
+import json
 import re
 import random
 from racetime_bot import RaceHandler, monitor_cmd, can_moderate, can_monitor, msg_actions
 
+from .breaker import CircuitOpenError
+from .log import set_log_context
+from .metrics import metrics
+from .outbox import ChatSender, LatestValueWriter
+
 
 def natjoin(sequence, default):
     if len(sequence) == 0:
@@ -64,7 +70,13 @@ class RandoHandler(RaceHandler):
     """
     seed_url = 'https://ootrandomizer.com/seed/get?id=%s'
     stop_at = ['cancelled', 'finished']
-    max_status_checks = 90
+    max_message_length = 1000
+    # Seconds to wait for further race info updates before sending one.
+    raceinfo_delay = 0.5
+    # Chat messages sent per second per room, and how many may be sent at
+    # once before that limit applies.
+    chat_rate = 1
+    chat_burst = 5
     greetings = (
         'Let me roll a seed for you. I promise it won\'t hurt.',
         'It\'s dangerous to go alone. Take this?',
@@ -73,10 +85,25 @@ class RandoHandler(RaceHandler):
         'All rolled seeds comply with the laws of thermodynamics.',
     )
 
-    def __init__(self, zsr, midos_house, **kwargs):
+    def __init__(self, zsr, midos_house, status_poller, state_store, seed_pool, **kwargs):
         super().__init__(**kwargs)
         self.zsr = zsr
         self.midos_house = midos_house
+        self.status_poller = status_poller
+        self.state_store = state_store
+        self.seed_pool = seed_pool
+        self._saved_state = None
+        # Held while a seed is being rolled and generated, see roll_and_send.
+        self.roll_lock = asyncio.Lock()
+        self.roll_task = None
+        self.raceinfo_writer = LatestValueWriter(super().set_bot_raceinfo, self.logger, delay=self.raceinfo_delay)
+        self.chat_sender = ChatSender(
+            super().send_message,
+            self.logger,
+            max_length=self.max_message_length,
+            rate=self.chat_rate,
+            burst=self.chat_burst,
+        )
         self.randomizer_branch = self.zsr.version_map['stable']
 
     async def should_stop(self):
@@ -98,56 +125,35 @@ class RandoHandler(RaceHandler):
         """
         Send introduction messages.
         """
+        set_log_context(race=self.data.get('name'))
         if await self.should_stop():
             return
+        self.zsr.add_listener(self)
+        self.restore_state()
+        set_log_context(seed_id=self.state.get('seed_id'))
         if not self.state.get('intro_sent') and not self._race_in_progress():
-            await self.send_message(
-                'Welcome to OoTR! ' + random.choice(self.greetings),
-                actions=[
-                    msg_actions.Action(
-                        label='Roll seed',
-                        help_text='Create a seed using one of many presets',
-                        message='!seed ${preset} ${--withpassword}',
-                        submit='Roll seed',
-                        survey=msg_actions.Survey(
-                            msg_actions.SelectInput(
-                                name='preset',
-                                label='Preset',
-                                options={key: value['full_name'] for key, value in self.randomizer_branch.presets.items()},
-                            ),
-                            msg_actions.BoolInput(
-                                name='--withpassword',
-                                label='Password',
-                                help_text='Locks file creation behind a 6 ocarina notes password provided at countdown start',
-                            ),
-                        ),
-                    ),
-                    msg_actions.Action(
-                        label='Change Branch',
-                        help_text='Change the branch to use when rolling the seed.',
-                        message='!branch ${branch}',
-                        submit='Select',
-                        survey=msg_actions.Survey(
-                            msg_actions.SelectInput(
-                                name='branch',
-                                label='Branch',
-                                options={key: value.name for key, value in self.zsr.version_map.items()}
-                            )
-                        ),
-                    ),
-                    msg_actions.ActionLink(
-                        label='Help',
-                        url='https://github.com/OoTRandomizer/rtgg-randobot/blob/master/COMMANDS.md',
-                    ),
-                ],
-                pinned=True,
-            )
-            await self.send_message(
-                f'The currently selected branch is: {self.randomizer_branch.name} v{self.randomizer_branch.version}'
-            )
+            if await self.randomizer_branch.ensure_loaded():
+                await self.send_message(
+                    'Welcome to OoTR! ' + random.choice(self.greetings),
+                    actions=self.seed_actions(self.randomizer_branch),
+                    pinned=True,
+                )
+                await self.send_message(
+                    f'The currently selected branch is: {self.randomizer_branch.name} v{self.randomizer_branch.version}'
+                )
+            else:
+                # No presets to offer, so skip the pinned seed survey.
+                await self.send_message('Welcome to OoTR! ' + random.choice(self.greetings))
+                await self.send_message(
+                    'Sorry, the %(branch)s branch is currently unavailable. '
+                    'Please try again in a few minutes.'
+                    % {'branch': self.randomizer_branch.name}
+                )
             self.state['intro_sent'] = True
         if 'locked' not in self.state:
             self.state['locked'] = False
+        if 'roll_state' not in self.state:
+            self.state['roll_state'] = 'idle'
         if 'fpa' not in self.state:
             self.state['fpa'] = False
         if 'password_active' not in self.state:
@@ -156,11 +162,146 @@ class RandoHandler(RaceHandler):
             self.state['password_published'] = False
         if 'password_retrieval_failed' not in self.state:
             self.state['password_retrieval_failed'] = False
+        self.save_state()
+        if self.state['roll_state'] == 'generating' or (
+            self.state['roll_state'] == 'ready' and not self.state.get('seed_hash')
+        ):
+            self.start_roll(self.resume_roll())
 
     async def end(self):
+        self.zsr.remove_listener(self)
+        if self.roll_task is not None:
+            self.roll_task.cancel()
+        await self.raceinfo_writer.flush()
+        await self.chat_sender.flush()
+        if self.state_store:
+            self.state_store.delete(self.data.get('name'))
         if self.state.get('pinned_msg'):
             await self.unpin_message(self.state['pinned_msg'])
 
+    async def send_message(self, message, actions=None, pinned=False, direct_to=None):
+        """
+        Queue a chat message, see ChatSender. Returns without waiting for it
+        to be sent.
+        """
+        self.chat_sender.put(message, actions=actions, pinned=pinned, direct_to=direct_to)
+
+    async def set_bot_raceinfo(self, info):
+        """
+        Queue an update of the race info. Updates made in quick succession
+        (e.g. seed URL, then hash, then password) are sent as one.
+        """
+        self.raceinfo_writer.set(info)
+
+    async def consume(self, data):
+        await super().consume(data)
+        self.save_state()
+
+    def restore_state(self):
+        """
+        Load state saved by a previous run of the bot, if this handler
+        doesn't have any yet.
+
+        The branch is taken from the state wherever it came from, since the
+        handler is recreated with the bot's in-memory state when the
+        websocket reconnects.
+        """
+        if not self.state and self.state_store:
+            saved = self.state_store.load(self.data.get('name'))
+            if saved:
+                self.state.update(saved)
+                if self.state.get('roll_state') == 'rolling':
+                    # We never got a seed ID back, so there's nothing to resume.
+                    self.state['roll_state'] = 'failed'
+                self.logger.info('[%(race)s] Restored saved state' % {'race': self.data.get('name')})
+        if self.state.get('branch') in self.zsr.version_map:
+            self.randomizer_branch = self.zsr.version_map[self.state['branch']]
+
+    def save_state(self):
+        """
+        Persist the current state, if it has changed since it was last saved.
+        """
+        if not self.state_store:
+            return
+        state = json.dumps(self.state)
+        if state != self._saved_state:
+            self.state_store.save(self.data.get('name'), state)
+            self._saved_state = state
+
+    async def resume_roll(self):
+        """
+        Pick up a seed that was still generating (or whose hash/password
+        hadn't been fetched yet) when the bot restarted. Run with start_roll,
+        so a failure is logged instead of stopping the bot's event loop.
+        """
+        if self.state.get('roll_state') == 'generating':
+            await self.check_seed_status()
+        elif self.state.get('roll_state') == 'ready':
+            await self.load_seed_hash()
+            if self.state.get('password_active') and not self.state.get('seed_password'):
+                await self.load_seed_password()
+
+    async def branch_updated(self, branch, old_version):
+        """
+        Let the room know when its selected branch has a new version, as
+        long as no seed has been rolled yet.
+        """
+        if branch is not self.randomizer_branch or self.state.get('seed_id'):
+            return
+        if self._race_in_progress() or self.data.get('status', {}).get('value') in self.stop_at:
+            return
+        await self.send_message(
+            f'{branch.name} has been updated from v{old_version} to v{branch.version}.'
+        )
+
+    def seed_actions(self, branch):
+        """
+        Build the "Roll seed"/"Change Branch" actions for a branch.
+
+        The result is cached on the branch until its presets are reloaded, so
+        it is shared by every room using that branch.
+        """
+        if 'seed_actions' not in branch.derived:
+            actions = [
+                msg_actions.Action(
+                    label='Roll seed',
+                    help_text='Create a seed using one of many presets',
+                    message='!seed ${preset} ${--withpassword}',
+                    submit='Roll seed',
+                    survey=msg_actions.Survey(
+                        msg_actions.SelectInput(
+                            name='preset',
+                            label='Preset',
+                            options={key: value['full_name'] for key, value in branch.presets.items()},
+                        ),
+                        msg_actions.BoolInput(
+                            name='--withpassword',
+                            label='Password',
+                            help_text='Locks file creation behind a 6 ocarina notes password provided at countdown start',
+                        ),
+                    ),
+                ),
+                msg_actions.Action(
+                    label='Change Branch',
+                    help_text='Change the branch to use when rolling the seed.',
+                    message='!branch ${branch}',
+                    submit='Select',
+                    survey=msg_actions.Survey(
+                        msg_actions.SelectInput(
+                            name='branch',
+                            label='Branch',
+                            options={key: value.name for key, value in self.zsr.version_map.items()}
+                        )
+                    ),
+                ),
+                msg_actions.ActionLink(
+                    label='Help',
+                    url='https://github.com/OoTRandomizer/rtgg-randobot/blob/master/COMMANDS.md',
+                ),
+            ]
+            branch.derived['seed_actions'] = {action.label: action.data for action in actions}
+        return branch.derived['seed_actions']
+
     async def chat_message(self, data):
         message = data.get('message', {})
         if (
@@ -170,6 +311,11 @@ class RandoHandler(RaceHandler):
             and message.get('message_plain', '').startswith('Welcome to OoTR!')
         ):
             self.state['pinned_msg'] = message.get('id')
+        words = message.get('message', '').lower().split(' ')
+        command = words[0][len(self.command_prefix):] if words[0].startswith(self.command_prefix) else None
+        if command and not message.get('is_bot') and hasattr(self, 'ex_' + command):
+            with metrics.timer('randobot_command_seconds', command=command):
+                return await super().chat_message(data)
         return await super().chat_message(data)
 
     async def race_data(self, data):
@@ -204,47 +350,19 @@ class RandoHandler(RaceHandler):
             return
         if len(args) == 1:
             if args[0] in self.zsr.version_map:
+                if not await self.zsr.version_map[args[0]].ensure_loaded():
+                    await self.send_message(
+                        'Sorry %(reply_to)s, that branch is currently unavailable. '
+                        'Please try again in a few minutes.'
+                        % {'reply_to': message.get('user', {}).get('name', 'friend')}
+                    )
+                    return
                 self.randomizer_branch = self.zsr.version_map[args[0]]
+                self.state['branch'] = args[0]
 
                 await self.send_message(
                     f'Randomizer branch changed to: {self.randomizer_branch.name} v{self.randomizer_branch.version}',
-                    actions=[
-                        msg_actions.Action(
-                            label='Roll seed',
-                            help_text='Create a seed using one of many presets',
-                            message='!seed ${preset} ${--withpassword}',
-                            submit='Roll seed',
-                            survey=msg_actions.Survey(
-                                msg_actions.SelectInput(
-                                    name='preset',
-                                    label='Preset',
-                                    options={key: value['full_name'] for key, value in self.randomizer_branch.presets.items()},
-                                ),
-                                msg_actions.BoolInput(
-                                    name='--withpassword',
-                                    label='Password',
-                                    help_text='Locks file creation behind a 6 ocarina notes password provided at countdown start',
-                                ),
-                            ),
-                        ),
-                        msg_actions.Action(
-                            label=' Change Branch',
-                            help_text='Change the branch to use when rolling the seed.',
-                            message='!branch ${branch}',
-                            submit='Select',
-                            survey=msg_actions.Survey(
-                                msg_actions.SelectInput(
-                                    name='branch',
-                                    label='Branch',
-                                    options={key: value.name for key, value in self.zsr.version_map.items()}
-                                )
-                            ),
-                        ),
-                        msg_actions.ActionLink(
-                            label='Help',
-                            url='https://github.com/OoTRandomizer/rtgg-randobot/blob/master/COMMANDS.md',
-                        ),
-                    ]
+                    actions=self.seed_actions(self.randomizer_branch),
                 )
             else:
                 await self.send_message(
@@ -312,7 +430,17 @@ class RandoHandler(RaceHandler):
         """
         if self._race_in_progress():
             return
-        await self.send_presets(self.randomizer_branch)
+        if not await self.randomizer_branch.ensure_loaded():
+            await self.send_message(
+                'Sorry %(reply_to)s, the %(branch)s branch is currently unavailable. '
+                'Please try again in a few minutes.'
+                % {
+                    'reply_to': message.get('user', {}).get('name', 'friend'),
+                    'branch': self.randomizer_branch.name,
+                }
+            )
+            return
+        await self.send_presets(self.randomizer_branch, ' '.join(args).strip().lower() or None)
 
     @monitor_cmd
     async def ex_password(self, args, message):
@@ -420,24 +548,68 @@ class RandoHandler(RaceHandler):
                 % {'reply_to': reply_to or 'friend'}
             )
             return
+        if self.rolling() or self.state.get('roll_state') in ('rolling', 'generating'):
+            await self.send_message(
+                'Hang on %(reply_to)s, I\'m already rolling a seed for this race.'
+                % {'reply_to': reply_to or 'friend'}
+            )
+            return
         if self.state.get('seed_id') and not can_moderate(message):
             await self.send_message(
                 'Well excuuuuuse me princess, but I already rolled a seed. '
                 'Don\'t get greedy!'
             )
             return
-        await self.roll(
+        self.start_roll(self.roll(
             preset=preset,
             branch=branch,
             encrypt=encrypt,
             reply_to=reply_to,
             password=password
-        )
+        ))
+
+    def rolling(self):
+        return (self.roll_task is not None and not self.roll_task.done()) or self.roll_lock.locked()
+
+    def start_roll(self, coro):
+        """
+        Run a roll in the background while holding roll_lock.
+
+        racetime_bot reads the room's messages one at a time, so a roll
+        awaited inside a command would hold up every later command until the
+        seed had finished generating, and a duplicate !seed would only be
+        seen once the roll was over.
+        """
+        self.roll_task = asyncio.ensure_future(self.run_roll(coro))
+
+    async def run_roll(self, coro):
+        try:
+            async with self.roll_lock:
+                await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.logger.error('[%(race)s] Rolling a seed failed' % {'race': self.data.get('name')}, exc_info=True)
+            if self.state.get('roll_state') in ('rolling', 'generating'):
+                # Otherwise every later !seed would be told to hang on.
+                self.state['roll_state'] = 'failed'
+            await self.send_message(
+                'Sorry, something went wrong while rolling the seed. Use '
+                '!seed to try again.'
+            )
+        self.save_state()
 
     async def roll(self, preset, branch, encrypt, reply_to, password=False):
         """
         Generate a seed and send it to the race room.
         """
+        if not await branch.ensure_loaded():
+            await self.send_message(
+                'Sorry %(reply_to)s, the %(branch)s branch is currently '
+                'unavailable. Please try again in a few minutes.'
+                % {'reply_to': reply_to or 'friend', 'branch': branch.name}
+            )
+            return
         if preset not in branch.presets:
             await self.send_message(
                 'Sorry %(reply_to)s, I don\'t recognise that preset. Use '
@@ -446,7 +618,33 @@ class RandoHandler(RaceHandler):
             )
             return
 
-        seed_id, seed_uri = self.zsr.roll_seed(preset, branch, encrypt, password)
+        self.state['roll_state'] = 'rolling'
+        pooled = self.seed_pool.take(branch, preset, encrypt, password) if self.seed_pool else None
+        if pooled:
+            seed_id, seed_uri = pooled
+        else:
+            try:
+                seed_id, seed_uri = await self.zsr.roll_seed(preset, branch, encrypt, password)
+            except CircuitOpenError:
+                self.state['roll_state'] = 'failed'
+                metrics.inc('randobot_rolls_total', outcome='unavailable')
+                await self.send_message(
+                    'Sorry %(reply_to)s, ootrandomizer.com seems to be having '
+                    'problems right now. Please try again in a few minutes.'
+                    % {'reply_to': reply_to or 'friend'}
+                )
+                return
+            except Exception:
+                self.state['roll_state'] = 'failed'
+                metrics.inc('randobot_rolls_total', outcome='error')
+                raise
+
+        # Record the seed before anything else can fail, so it isn't lost.
+        self.state['seed_id'] = seed_id
+        set_log_context(seed_id=seed_id)
+        if not pooled:
+            self.state['roll_state'] = 'generating'
+        self.save_state()
 
         await self.send_message(
             '%(reply_to)s, here is your seed: %(seed_uri)s'
@@ -458,37 +656,43 @@ class RandoHandler(RaceHandler):
             )
         await self.set_bot_raceinfo(seed_uri)
         if self.state.get('pinned_msg'):
-            await self.unpin_message(self.state['pinned_msg'])
+            try:
+                await self.unpin_message(self.state['pinned_msg'])
+            except Exception:
+                self.logger.warning('[%(race)s] Could not unpin the seed survey' % {'race': self.data.get('name')}, exc_info=True)
             del self.state['pinned_msg']
 
-        self.state['seed_id'] = seed_id
-        self.state['status_checks'] = 0
-
+        if pooled:
+            metrics.inc('randobot_rolls_total', outcome='pooled')
+            await self.seed_ready()
+            return
         await self.check_seed_status()
 
     async def check_seed_status(self):
-        while self.state['status_checks'] < self.max_status_checks:
-            status = self.zsr.get_status(self.state['seed_id'])
-
-            if status == 0:
-                self.state['status_checks'] += 1
-                await sleep(2)
-            elif status == 1:
-                await self.load_seed_hash()
-                if self.state.get('password_active'):
-                    await self.load_seed_password()
-                return
-            elif status >= 2:
-                break
+        status = await self.status_poller.wait(self.state['seed_id'])
+        if status == 1:
+            metrics.inc('randobot_rolls_total', outcome='success')
+            await self.seed_ready()
+            return
 
+        metrics.inc('randobot_rolls_total', outcome='failure')
         self.state['seed_id'] = None
+        set_log_context(seed_id=None)
+        self.state['roll_state'] = 'failed'
         await self.send_message(
             'Sorry, but it looks like the seed failed to generate. Use '
             '!seed to try again.'
         )
 
+    async def seed_ready(self):
+        self.state['roll_state'] = 'ready'
+        self.save_state()
+        await self.load_seed_hash()
+        if self.state.get('password_active'):
+            await self.load_seed_password()
+
     async def load_seed_password(self, manual=False):
-        seed_password = self.zsr.get_password(self.state['seed_id'])
+        seed_password = await self.zsr.get_password(self.state['seed_id'])
         if seed_password is None:
             if manual:
                 return False
@@ -505,20 +709,40 @@ class RandoHandler(RaceHandler):
                 return True
 
     async def load_seed_hash(self):
-        seed_hash = self.zsr.get_hash(self.state['seed_id'])
+        seed_hash = await self.zsr.get_hash(self.state['seed_id'])
         self.state['seed_hash'] = seed_hash
         await self.set_bot_raceinfo('%(seed_hash)s\n%(seed_url)s' % {
             'seed_hash': seed_hash,
             'seed_url': self.seed_url % self.state['seed_id'],
         })
 
-    async def send_presets(self, branch):
+    async def send_presets(self, branch, search=None):
         """
-        Send a list of known presets to the race room.
+        Send a list of known presets to the race room, optionally only those
+        whose name contains `search`.
+
+        The list is sent as a single message, split only if it would exceed
+        racetime.gg's message length limit.
         """
-        await self.send_message('Available presets:')
-        for name, preset in branch.presets.items():
-            await self.send_message('%s – %s' % (name, preset['full_name']))
+        lines = [
+            '%s – %s' % (name, preset['full_name'])
+            for name, preset in branch.presets.items()
+            if not search or search in name.lower() or search in preset['full_name'].lower()
+        ]
+        if not lines:
+            if search:
+                await self.send_message('Sorry, no presets match "%s".' % search)
+            else:
+                await self.send_message('Sorry, no presets are available for the %s branch.' % branch.name)
+            return
+        messages = ['Available presets:']
+        for line in lines:
+            if len(messages[-1]) + 1 + len(line) > self.max_message_length:
+                messages.append(line)
+            else:
+                messages[-1] += '\n' + line
+        for text in messages:
+            await self.send_message(text)
 
     def _race_pending(self):
         return self.data.get('status').get('value') == 'pending'
@@ -0,0 +1,158 @@
+import asyncio
+import atexit
+import contextvars
+import copy
+import datetime
+import importlib.util
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+# Per-room context (race slug, seed ID) added to every log record. Each race
+# handler runs in its own task, so setting this in a handler only affects
+# that room's records.
+log_context = contextvars.ContextVar('randobot_log_context', default={})
+
+
+def set_log_context(**kwargs):
+    log_context.set({**log_context.get(), **kwargs})
+
+
+def detached_task(coro):
+    """
+    Start a task that doesn't inherit the current room's log context.
+
+    Use for tasks of services shared by all rooms (the status poller, the
+    request scheduler, cache fetches...), which would otherwise tag all
+    their records with whichever room happened to start them.
+    """
+    return contextvars.Context().run(asyncio.ensure_future, coro)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Copy the current room's log context onto each record, unless the call
+    passed the fields explicitly via `extra`.
+    """
+    def filter(self, record):
+        context = log_context.get()
+        record.__dict__.setdefault('race', context.get('race'))
+        record.__dict__.setdefault('seed_id', context.get('seed_id'))
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Rate-limit chatty records per call site.
+
+    Debug records, and info records logged from inside one of `packages`
+    (racetime_bot logs every chat message and websocket send at INFO), are
+    let through from any one line of code at up to `rate` per second (with
+    bursts of `burst`), anything more is dropped. The next record let
+    through from that line carries the number dropped in between as
+    `record.suppressed`. The bot's own info records, warnings and errors
+    are never dropped.
+    """
+    def __init__(self, rate=5, burst=20, packages=('racetime_bot',)):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sites = {}
+        self.info_paths = tuple(
+            path
+            for spec in map(importlib.util.find_spec, packages) if spec
+            for path in spec.submodule_search_locations or ()
+        )
+
+    def filter(self, record):
+        record.suppressed = 0
+        if record.levelno > logging.INFO:
+            return True
+        if record.levelno == logging.INFO and not record.pathname.startswith(self.info_paths):
+            return True
+        now = time.monotonic()
+        site = (record.pathname, record.lineno)
+        tokens, updated_at, suppressed = self.sites.get(site, (self.burst, now, 0))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        if tokens < 1:
+            self.sites[site] = (tokens, now, suppressed + 1)
+            return False
+        record.suppressed = suppressed
+        self.sites[site] = (tokens - 1, now, 0)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format records as one JSON object per line.
+    """
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key in ('race', 'seed_id', 'suppressed'):
+            if getattr(record, key, None):
+                data[key] = getattr(record, key)
+        if record.exc_text:
+            data['exc_info'] = record.exc_text
+        return json.dumps(data)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that keeps a record's traceback apart from its message.
+
+    The stock handler folds the traceback into the message before queueing
+    the record, so the JSON formatter couldn't put it in its own field.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Format the traceback now, before its frames change under the
+            # listener thread.
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('[%(asctime)s] %(name)s (%(levelname)s) :: %(message)s')
+
+    def format(self, record):
+        text = super().format(record)
+        if getattr(record, 'suppressed', 0):
+            text += ' (%d similar messages suppressed)' % record.suppressed
+        return text
+
+
+def setup_logging(logger, verbose=False, json_output=False):
+    """
+    Send `logger`'s records through a queue to a background thread that
+    writes them to stdout, so logging never blocks the event loop.
+    """
+    log_queue = queue.SimpleQueue() if hasattr(queue, 'SimpleQueue') else queue.Queue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(SamplingFilter())
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if json_output else TextFormatter())
+
+    if verbose:
+        logger.setLevel(logging.DEBUG)
+        queue_handler.setLevel(logging.DEBUG)
+    logger.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,148 @@
+import asyncio
+from contextlib import contextmanager
+import json
+import time
+
+
+class Histogram:
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or self.default_buckets
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        # Bucket counts are cumulative, as in Prometheus.
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+    """
+    Minimal in-process metrics registry of counters and histograms.
+
+    Nothing is recorded unless `enabled` is set. Metrics can be exported in
+    the Prometheus text format (`render`, `serve`) or as a periodic JSON log
+    line (`log_periodically`).
+    """
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.histograms = {}
+        self.bucket_overrides = {}
+        self.collectors = []
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(self.bucket_overrides.get(name))
+        self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Record how long the body of a `with` block takes, in seconds.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def add_collector(self, collector):
+        """
+        Register a function returning (name, labels, value) gauge readings,
+        evaluated whenever metrics are exported.
+        """
+        self.collectors.append(collector)
+
+    def gauges(self):
+        for collector in self.collectors:
+            yield from collector()
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        def fmt_labels(labels):
+            if not labels:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels)
+
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append('%s%s %s' % (name, fmt_labels(labels), value))
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append('%s_bucket%s %d' % (name, fmt_labels(labels + (('le', bound),)), count))
+            lines.append('%s_bucket%s %d' % (name, fmt_labels(labels + (('le', '+Inf'),)), histogram.count))
+            lines.append('%s_sum%s %f' % (name, fmt_labels(labels), histogram.sum))
+            lines.append('%s_count%s %d' % (name, fmt_labels(labels), histogram.count))
+        for name, labels, value in self.gauges():
+            lines.append('%s%s %s' % (name, fmt_labels(tuple(sorted(labels.items()))), value))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        A compact dict of all metrics, for structured logging.
+        """
+        def key(name, labels):
+            return name + ''.join('[%s=%s]' % label for label in labels)
+
+        data = {key(name, labels): value for (name, labels), value in self.counters.items()}
+        for (name, labels), histogram in self.histograms.items():
+            data[key(name, labels)] = {
+                'count': histogram.count,
+                'avg': histogram.sum / histogram.count if histogram.count else 0,
+            }
+        for name, labels, value in self.gauges():
+            data[key(name, tuple(sorted(labels.items())))] = value
+        return data
+
+    async def monitor_loop_lag(self, interval=0.5):
+        """
+        Measure how late a periodic timer fires, i.e. how long the event loop
+        was blocked.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.observe('randobot_event_loop_lag_seconds', max(0.0, loop.time() - expected))
+
+    async def serve(self, port, host='127.0.0.1'):
+        """
+        Serve metrics over HTTP at /metrics.
+        """
+        from aiohttp import web
+
+        async def handle(request):
+            return web.Response(text=self.render(), content_type='text/plain')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+
+    async def log_periodically(self, logger, interval):
+        while True:
+            await asyncio.sleep(interval)
+            logger.info('metrics %s' % json.dumps(self.summary(), sort_keys=True))
+
+
+metrics = Metrics()
+metrics.bucket_overrides['randobot_status_checks_per_seed'] = (1, 2, 5, 10, 20, 40, 90)
@@ -1,33 +1,76 @@
+import asyncio
 import time
 
-import gql
-from gql.transport.aiohttp import AIOHTTPTransport
-from gql.transport.exceptions import TransportError
-
+from .cache import DiskCache
+from .log import detached_task
 from .utils import capture_exception
 
 
 class MidosHouse:
-    def __init__(self):
-        self.client = gql.Client(transport=AIOHTTPTransport(url='https://midos.house/api/v1/graphql'))
-        self.cache = None
+    """
+    Keeps track of which custom goals Mido's House handles.
+
+    The list of goal names is refreshed once a day by a single background
+    task. Rooms keep using the previous list while it is being refreshed,
+    and only wait for it if there has never been one. If `cache_dir` is
+    given, the last list fetched is kept there so it is available right
+    away after a restart.
+
+    The GraphQL client (and the gql package) is only loaded when the list is
+    first fetched, since many bot instances never see a custom goal.
+    """
+    url = 'https://midos.house/api/v1/graphql'
+    ttl = 60 * 60 * 24
+    retry_after_error = 60
+
+    def __init__(self, cache_dir=None):
+        self._client = None
+        self.disk_cache = DiskCache(cache_dir) if cache_dir else None
+        self.goal_names = None
         self.cache_expires_at = time.monotonic()
+        self._refresh_task = None
+        if self.disk_cache:
+            entry = self.disk_cache.get(self.url, {'query': 'goalNames'})
+            if entry:
+                # We don't know how old this is, so it's refreshed on first use.
+                self.goal_names = frozenset(entry['body'])
+
+    @property
+    def client(self):
+        if self._client is None:
+            import gql
+            from gql.transport.aiohttp import AIOHTTPTransport
+            self._client = gql.Client(transport=AIOHTTPTransport(url=self.url))
+        return self._client
 
     async def handles_custom_goal(self, goal_name):
         if time.monotonic() >= self.cache_expires_at:
-            try:
-                query = gql.gql("""
-                    query {
-                        goalNames
-                    }
-                """)
-                response = await self.client.execute_async(query)
-                self.cache_expires_at = time.monotonic() + 60 * 60 * 24
-                self.cache = response['goalNames']
-            except TransportError as ex:  # if anything goes wrong, assume Mido's House is down and we should handle the room
-                capture_exception(ex)
-                self.cache_expires_at = time.monotonic() + 60
-                self.cache = None
-        if self.cache is None:
+            task = self.refresh_in_background()
+            if self.goal_names is None:
+                await asyncio.shield(task)
+        if self.goal_names is None:
             return False
-        return goal_name in self.cache
+        return goal_name in self.goal_names
+
+    def refresh_in_background(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = detached_task(self.refresh())
+        return self._refresh_task
+
+    async def refresh(self):
+        try:
+            import gql
+            query = gql.gql("""
+                query {
+                    goalNames
+                }
+            """)
+            response = await self.client.execute_async(query)
+        except Exception as ex:  # if anything goes wrong, assume Mido's House is down and keep the list we have, if any
+            capture_exception(ex)
+            self.cache_expires_at = time.monotonic() + self.retry_after_error
+            return
+        self.goal_names = frozenset(response['goalNames'])
+        self.cache_expires_at = time.monotonic() + self.ttl
+        if self.disk_cache:
+            self.disk_cache.set(self.url, {'query': 'goalNames'}, response['goalNames'])
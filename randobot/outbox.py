@@ -0,0 +1,130 @@
+import asyncio
+from collections import deque
+
+from .scheduler import TokenBucket
+from .utils import capture_exception
+
+
+class LatestValueWriter:
+    """
+    Sends a value that is updated in bursts, such as a race room's info.
+
+    `set` returns immediately. The value is sent by a single background
+    task once no new value has been set for `delay` seconds; intermediate
+    values are dropped, and a value equal to the last one sent is not sent
+    again. Since there is only one sender, updates can't overtake each
+    other.
+    """
+    def __init__(self, send, logger, delay=0.5):
+        self.send = send
+        self.logger = logger
+        self.delay = delay
+        self.pending = None
+        self.sent = None
+        self._changed = asyncio.Event()
+        self._flush = False
+        self._task = None
+
+    def set(self, value):
+        self.pending = value
+        self._changed.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while self.pending is not None:
+            # Wait until nothing new has been set for `delay` seconds.
+            while not self._flush:
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), self.delay)
+                except asyncio.TimeoutError:
+                    break
+            value, self.pending = self.pending, None
+            if value == self.sent:
+                continue
+            try:
+                await self.send(value)
+            except Exception as ex:
+                self.logger.warning('Could not send update %r' % (value,), exc_info=True)
+                capture_exception(ex)
+            else:
+                self.sent = value
+
+    async def flush(self):
+        """
+        Send any pending value now and wait for it to go out.
+        """
+        if self._task is None or self._task.done():
+            return
+        self._flush = True
+        self._changed.set()
+        try:
+            await self._task
+        finally:
+            self._flush = False
+
+
+class ChatSender:
+    """
+    Per-room queue of outgoing chat messages.
+
+    `put` returns immediately; a background task sends queued messages at
+    up to `rate` per second (with bursts of `burst`). While messages are
+    waiting, consecutive plain ones (no actions, not pinned, same recipient)
+    are joined with newlines as long as the result stays within
+    `max_length`.
+    """
+    def __init__(self, send, logger, max_length=1000, rate=1, burst=5):
+        self.send = send
+        self.logger = logger
+        self.max_length = max_length
+        self.bucket = TokenBucket(rate, burst)
+        self.queue = deque()
+        self._task = None
+
+    def put(self, message, actions=None, pinned=False, direct_to=None):
+        plain = not actions and not pinned
+        last = self.queue[-1] if self.queue else None
+        if (
+            plain and last and last['plain'] and last['direct_to'] == direct_to
+            and len(last['message']) + 1 + len(message) <= self.max_length
+        ):
+            last['message'] += '\n' + message
+        else:
+            self.queue.append({
+                'message': message,
+                'actions': actions,
+                'pinned': pinned,
+                'direct_to': direct_to,
+                'plain': plain,
+            })
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while self.queue:
+            delay = self.bucket.wait_time(loop.time())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            self.bucket.take()
+            item = self.queue.popleft()
+            try:
+                await self.send(
+                    item['message'],
+                    actions=item['actions'],
+                    pinned=item['pinned'],
+                    direct_to=item['direct_to'],
+                )
+            except Exception as ex:
+                self.logger.warning('Could not send chat message %r' % item['message'], exc_info=True)
+                capture_exception(ex)
+
+    async def flush(self):
+        """
+        Wait until every queued message has been sent.
+        """
+        if self._task is not None and not self._task.done():
+            await self._task
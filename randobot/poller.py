@@ -0,0 +1,125 @@
+import asyncio
+
+from .breaker import CircuitOpenError
+from .log import detached_task
+from .metrics import metrics
+
+
+class StatusPoller:
+    """
+    Polls ootrandomizer.com for the generation status of seeds on behalf of
+    every race room the bot is handling.
+
+    Rooms register a seed ID with `wait` and get back the final status. One
+    scheduling pass is made per tick, checking only the seeds that are due,
+    so the number of status requests per second is bounded by
+    `max_requests_per_tick / tick` no matter how many rooms are rolling.
+    Each check runs as its own task, so a slow request for one seed doesn't
+    hold up the others.
+    """
+    tick = 1
+    max_requests_per_tick = 10
+    # (seed age in seconds, delay until next check). Seeds usually finish
+    # quickly, so check often at first and back off for slow ones.
+    intervals = (
+        (20, 2),
+        (60, 4),
+        (None, 8),
+    )
+    timeout = 180
+
+    def __init__(self, zsr, logger):
+        self.zsr = zsr
+        self.logger = logger
+        self.seeds = {}
+        self._task = None
+
+    async def wait(self, seed_id):
+        """
+        Wait for a seed to finish generating.
+
+        Returns the final status code from ootrandomizer.com (1 for success,
+        2 or higher for failure), or None if the seed didn't finish in time.
+        """
+        if seed_id not in self.seeds:
+            loop = asyncio.get_running_loop()
+            self.seeds[seed_id] = {
+                'future': loop.create_future(),
+                'registered_at': loop.time(),
+                'next_check': loop.time() + self.next_interval(0),
+                'checks': 0,
+                'in_flight': False,
+            }
+        if self._task is None or self._task.done():
+            self._task = detached_task(self.run())
+        return await asyncio.shield(self.seeds[seed_id]['future'])
+
+    def next_interval(self, age):
+        for max_age, interval in self.intervals:
+            if max_age is None or age < max_age:
+                return interval
+
+    async def run(self):
+        while self.seeds:
+            await asyncio.sleep(self.tick)
+            self.poll()
+
+    def poll(self):
+        """
+        Start a check for every seed that is due and not already being
+        checked, up to `max_requests_per_tick`.
+        """
+        now = asyncio.get_running_loop().time()
+        due = sorted(
+            (
+                seed_id for seed_id, seed in self.seeds.items()
+                if seed['next_check'] <= now and not seed['in_flight']
+            ),
+            key=lambda seed_id: self.seeds[seed_id]['next_check'],
+        )[:self.max_requests_per_tick]
+        for seed_id in due:
+            self.seeds[seed_id]['in_flight'] = True
+            detached_task(self.check(seed_id))
+
+    async def check(self, seed_id):
+        seed = self.seeds[seed_id]
+        try:
+            await self._check(seed_id, seed)
+        finally:
+            seed['in_flight'] = False
+
+    async def _check(self, seed_id, seed):
+        # While ootrandomizer.com's circuit is open, don't count a check and
+        # wait until it may have closed rather than retrying every tick.
+        retry_in = None
+        try:
+            status = await self.zsr.get_status(seed_id)
+            seed['checks'] += 1
+        except CircuitOpenError as ex:
+            status = 0
+            retry_in = ex.retry_in
+        except Exception:
+            self.logger.warning('Status check failed for seed %s' % seed_id, exc_info=True, extra={'seed_id': seed_id})
+            status = 0
+            seed['checks'] += 1
+
+        loop = asyncio.get_running_loop()
+        age = loop.time() - seed['registered_at']
+        if status == 0 and age < self.timeout:
+            # Logged for every check of every seed, so sampled by the
+            # logging pipeline when many seeds are generating at once.
+            self.logger.debug('Seed %(seed_id)s still generating after %(checks)d checks' % {
+                'seed_id': seed_id,
+                'checks': seed['checks'],
+            }, extra={'seed_id': seed_id})
+            seed['next_check'] = loop.time() + max(self.next_interval(age), retry_in or 0)
+            return
+        self.logger.info('Seed %(seed_id)s finished with status %(status)s after %(checks)d checks' % {
+            'seed_id': seed_id,
+            'status': status,
+            'checks': seed['checks'],
+        }, extra={'seed_id': seed_id})
+        del self.seeds[seed_id]
+        metrics.observe('randobot_status_checks_per_seed', seed['checks'])
+        if not seed['future'].done():
+            seed['future'].set_result(status if status != 0 else None)
@@ -0,0 +1,98 @@
+import asyncio
+import datetime
+from email.utils import parsedate_to_datetime
+import random
+
+import aiohttp
+
+
+class RetryableError(Exception):
+    """
+    Raised by a request callable to signal that it should be attempted again,
+    e.g. when the API responded but the data isn't available yet.
+    """
+
+
+class RetryPolicy:
+    """
+    Async retry engine using exponential backoff with full jitter.
+
+    `attempts` is the maximum number of calls made, `budget` is the maximum
+    number of seconds a single `call` may spend (including time spent waiting
+    between attempts). Only errors deemed transient by `is_retryable` are
+    retried, anything else is raised immediately.
+    """
+    def __init__(self, attempts=3, base_delay=1, max_delay=10, budget=30):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+
+    def is_retryable(self, error):
+        if isinstance(error, (RetryableError, asyncio.TimeoutError, aiohttp.ClientConnectionError)):
+            return True
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status == 429 or error.status >= 500
+        return False
+
+    def retry_after(self, error):
+        """
+        Return the delay requested by the server via a Retry-After header, if
+        there is one.
+        """
+        headers = getattr(error, 'headers', None)
+        if not headers or 'Retry-After' not in headers:
+            return None
+        value = headers['Retry-After']
+        try:
+            return max(0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Await `func(*args, **kwargs)`, retrying transient failures.
+
+        The last error is re-raised once attempts or budget run out.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.budget
+        for attempt in range(self.attempts):
+            try:
+                return await func(*args, **kwargs)
+            except Exception as ex:
+                if attempt >= self.attempts - 1 or not self.is_retryable(ex):
+                    raise
+                delay = self.retry_after(ex)
+                if delay is None:
+                    delay = self.backoff(attempt)
+                if loop.time() + delay > deadline:
+                    raise
+                await asyncio.sleep(delay)
+
+
+class NonIdempotentRetryPolicy(RetryPolicy):
+    """
+    Retry policy for requests that must not be sent twice, such as creating
+    a seed.
+
+    Only retries when the request can't have reached the server (the
+    connection couldn't be established), or when the server rejected it with
+    429/503 and said when to try again with Retry-After. Timeouts and
+    dropped connections are not retried, since the server may already have
+    acted on the request.
+    """
+    def is_retryable(self, error):
+        if isinstance(error, aiohttp.ClientConnectorError):
+            return True
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status in (429, 503) and self.retry_after(error) is not None
+        return False
@@ -0,0 +1,145 @@
+import asyncio
+import heapq
+import itertools
+
+from .log import detached_task
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per second on average, with bursts of up to
+    `burst` requests.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = None
+
+    def refill(self, now):
+        if self.updated_at is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now):
+        """
+        Seconds until a token is available (0 if one is available now).
+        """
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class RequestScheduler:
+    """
+    Central scheduler for outbound API requests.
+
+    Each endpoint has its own token bucket, and all endpoints share a global
+    bucket. Requests waiting for capacity are released in priority order
+    (lower number first), so under load important requests such as seed
+    creation go out before background ones such as version checks.
+    """
+    def __init__(self, limits, priorities, global_limit):
+        self.buckets = {
+            endpoint: TokenBucket(rate, burst)
+            for endpoint, (rate, burst) in limits.items()
+        }
+        self.global_bucket = TokenBucket(*global_limit)
+        self.priorities = priorities
+        self.waiting = []
+        self.counter = itertools.count()
+        self.stats = {
+            endpoint: {'requests': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+            for endpoint in limits
+        }
+        self._task = None
+
+    async def acquire(self, endpoint):
+        """
+        Wait until a request to `endpoint` may be sent.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self.waiting, (
+            self.priorities.get(endpoint, 0),
+            next(self.counter),
+            endpoint,
+            loop.time(),
+            future,
+        ))
+        self.release()
+        if not future.done() and (self._task is None or self._task.done()):
+            self._task = detached_task(self.run())
+        await future
+
+    def release(self):
+        """
+        Let through as many waiting requests as capacity allows. Returns the
+        number of seconds until more capacity is available.
+        """
+        now = asyncio.get_running_loop().time()
+        next_wait = None
+        blocked = []
+        while self.waiting:
+            entry = heapq.heappop(self.waiting)
+            priority, _, endpoint, enqueued_at, future = entry
+            if future.done():
+                continue  # caller gave up
+            global_wait = self.global_bucket.wait_time(now)
+            if global_wait > 0:
+                # Out of global capacity: nobody can go, lower priorities
+                # must not jump ahead of this request.
+                blocked.append(entry)
+                next_wait = global_wait
+                break
+            bucket = self.buckets.get(endpoint)
+            endpoint_wait = bucket.wait_time(now) if bucket else 0
+            if endpoint_wait > 0:
+                blocked.append(entry)
+                next_wait = endpoint_wait if next_wait is None else min(next_wait, endpoint_wait)
+                continue
+            self.global_bucket.take()
+            if bucket:
+                bucket.take()
+            self.record(endpoint, now - enqueued_at)
+            future.set_result(None)
+        for entry in blocked:
+            heapq.heappush(self.waiting, entry)
+        return next_wait
+
+    async def run(self):
+        while self.waiting:
+            next_wait = self.release()
+            if next_wait is None:
+                break
+            await asyncio.sleep(next_wait)
+
+    def record(self, endpoint, wait):
+        stats = self.stats.setdefault(endpoint, {'requests': 0, 'wait_total': 0.0, 'wait_max': 0.0})
+        stats['requests'] += 1
+        stats['wait_total'] += wait
+        stats['wait_max'] = max(stats['wait_max'], wait)
+
+    def queue_depth(self, endpoint=None):
+        return sum(
+            1 for _, _, waiting_endpoint, _, future in self.waiting
+            if not future.done() and (endpoint is None or waiting_endpoint == endpoint)
+        )
+
+    def metrics(self):
+        """
+        Current queue depth and wait-time statistics per endpoint.
+        """
+        return {
+            endpoint: {
+                'queue_depth': self.queue_depth(endpoint),
+                'requests': stats['requests'],
+                'wait_avg': stats['wait_total'] / stats['requests'] if stats['requests'] else 0.0,
+                'wait_max': stats['wait_max'],
+            }
+            for endpoint, stats in self.stats.items()
+        }
@@ -0,0 +1,115 @@
+import asyncio
+
+from .breaker import CircuitOpenError
+from .log import detached_task
+
+
+class SeedPool:
+    """
+    Keeps a few already generated, not yet revealed seeds ready for popular
+    presets, so `!seed` can hand one out immediately.
+
+    Pools are keyed by (branch, preset, encrypt, password). Each configured
+    pool is topped up to `size` seeds in the background, seeds older than
+    `ttl` seconds are thrown away, and (if `invalidate_on_version_bump` is
+    set) so are seeds rolled on an older version of their branch.
+    """
+    maintain_every = 60
+
+    def __init__(self, zsr, status_poller, logger, keys, size=2, ttl=60 * 60 * 6,
+                 invalidate_on_version_bump=True):
+        self.zsr = zsr
+        self.status_poller = status_poller
+        self.logger = logger
+        self.size = size
+        self.ttl = ttl
+        self.invalidate_on_version_bump = invalidate_on_version_bump
+        self.seeds = {key: [] for key in keys}
+        self._refills = {}
+        self.zsr.add_listener(self)
+
+    @staticmethod
+    def parse_key(spec):
+        """
+        Parse a pool spec of the form `[branch:]preset[+spoiler][+password]`,
+        e.g. "weekly" or "dev:s8+password".
+        """
+        spec, *flags = spec.split('+')
+        branch, _, preset = spec.rpartition(':')
+        return (branch or 'stable', preset, 'spoiler' not in flags, 'password' in flags)
+
+    @staticmethod
+    def key(branch, preset, encrypt, password):
+        return (branch.rtgg_arg, preset, bool(encrypt), bool(password))
+
+    def take(self, branch, preset, encrypt, password):
+        """
+        Remove and return a ready (seed_id, seed_uri) for this combination, or
+        None if there isn't one. Starts a refill either way.
+        """
+        key = self.key(branch, preset, encrypt, password)
+        if key not in self.seeds:
+            return None
+        self.prune(key)
+        seed = self.seeds[key].pop(0) if self.seeds[key] else None
+        self.refill_in_background(key)
+        if seed is None:
+            return None
+        return seed['seed_id'], seed['seed_uri']
+
+    def prune(self, key):
+        now = asyncio.get_running_loop().time()
+        branch = self.zsr.version_map.get(key[0])
+        self.seeds[key] = [
+            seed for seed in self.seeds[key]
+            if now - seed['created_at'] < self.ttl
+            and not (self.invalidate_on_version_bump and branch and seed['version'] != branch.version)
+        ]
+
+    def refill_in_background(self, key):
+        if key not in self._refills or self._refills[key].done():
+            self._refills[key] = detached_task(self.refill(key))
+
+    async def refill(self, key):
+        branch_name, preset, encrypt, password = key
+        branch = self.zsr.version_map.get(branch_name)
+        if branch is None or not await branch.ensure_loaded() or preset not in branch.presets:
+            return
+        while len(self.seeds[key]) < self.size:
+            version = branch.version
+            try:
+                seed_id, seed_uri = await self.zsr.roll_seed(preset, branch, encrypt, password, endpoint='pool_create')
+                status = await self.status_poller.wait(seed_id)
+            except CircuitOpenError:
+                return  # ootrandomizer.com is failing, try again at the next maintenance pass
+            except Exception:
+                self.logger.warning('Could not roll a pooled %s seed' % preset, exc_info=True)
+                return  # try again at the next maintenance pass
+            if status != 1:
+                self.logger.warning('Pooled %s seed %s failed to generate' % (preset, seed_id))
+                return
+            self.seeds[key].append({
+                'seed_id': seed_id,
+                'seed_uri': seed_uri,
+                'version': version,
+                'created_at': asyncio.get_running_loop().time(),
+            })
+            self.prune(key)
+
+    async def branch_updated(self, branch, old_version):
+        if not self.invalidate_on_version_bump:
+            return
+        for key in self.seeds:
+            if key[0] == branch.rtgg_arg:
+                self.prune(key)
+                self.refill_in_background(key)
+
+    async def run(self):
+        """
+        Periodically drop expired seeds and top up every pool.
+        """
+        while True:
+            for key in self.seeds:
+                self.prune(key)
+                self.refill_in_background(key)
+            await asyncio.sleep(self.maintain_every)
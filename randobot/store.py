@@ -0,0 +1,55 @@
+import json
+import os
+import sqlite3
+import time
+
+
+class StateStore:
+    """
+    Persists race handler state in a local SQLite database, keyed by race
+    slug, so that a restarted bot can pick up where it left off.
+    """
+    max_age = 60 * 60 * 24 * 7
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS race_state ('
+            'slug TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)'
+        )
+        self.prune()
+
+    def load(self, slug):
+        row = self.db.execute('SELECT state FROM race_state WHERE slug = ?', (slug,)).fetchone()
+        if row is None:
+            return None
+        try:
+            return json.loads(row[0])
+        except ValueError:
+            return None
+
+    def save(self, slug, state):
+        """
+        Store the state for a race. `state` may be a dict or an already
+        JSON-encoded string.
+        """
+        if not isinstance(state, str):
+            state = json.dumps(state)
+        self.db.execute(
+            'INSERT OR REPLACE INTO race_state (slug, state, updated_at) VALUES (?, ?, ?)',
+            (slug, state, time.time()),
+        )
+
+    def delete(self, slug):
+        self.db.execute('DELETE FROM race_state WHERE slug = ?', (slug,))
+
+    def prune(self):
+        """
+        Forget races that haven't been updated in a long time.
+        """
+        self.db.execute('DELETE FROM race_state WHERE updated_at < ?', (time.time() - self.max_age,))
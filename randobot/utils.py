@@ -1,3 +1,6 @@
+import os
+
+
 def capture_exception(error=None, scope=None, **scope_kwargs):
     try:
         from sentry_sdk import capture_exception
@@ -5,3 +8,18 @@ def capture_exception(error=None, scope=None, **scope_kwargs):
         pass
     else:
         capture_exception(error, scope, **scope_kwargs)
+
+
+def default_cache_dir():
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'randobot',
+    )
+
+
+def default_state_db():
+    return os.path.join(
+        os.environ.get('XDG_STATE_HOME') or os.path.expanduser('~/.local/state'),
+        'randobot',
+        'state.sqlite3',
+    )
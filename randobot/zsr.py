@@ -1,6 +1,64 @@
+import asyncio
+import gzip
 import json
-import requests
+import re
 import time
+import weakref
+
+import aiohttp
+
+from .breaker import CircuitBreaker, CircuitOpenError
+from .cache import AsyncLRUCache, DiskCache
+from .log import detached_task
+from .metrics import metrics
+from .retry import NonIdempotentRetryPolicy, RetryableError, RetryPolicy
+from .scheduler import RequestScheduler
+from .utils import capture_exception
+
+
+def extract_settings_log_field(body, name, window=4096):
+    """
+    Pull a single small field out of a seed details response without parsing
+    the whole document.
+
+    The settings log is embedded in the response as a JSON-encoded string, so
+    the field is looked for in both its escaped and plain forms. Only a short
+    window after the key is decoded. Returns None if the field can't be found
+    or decoded this way, in which case use `parse_settings_log` instead.
+    """
+    for escaped in (True, False):
+        key = ('\\"%s\\"' if escaped else '"%s"') % name
+        index = body.find(key)
+        if index == -1:
+            continue
+        colon = body.find(':', index + len(key))
+        if colon == -1:
+            return None
+        value = body[colon + 1:colon + 1 + window]
+        try:
+            if escaped:
+                # Stop at the unescaped quote closing the settings log string,
+                # and drop any escape sequence cut in half by the window.
+                end = re.search(r'(?<!\\)"', value)
+                if end:
+                    value = value[:end.start()]
+                value = json.loads('"' + value.rstrip('\\') + '"')
+            return json.JSONDecoder().raw_decode(value.lstrip())[0]
+        except ValueError:
+            return None
+    return None
+
+
+def parse_settings_log(body, names):
+    """
+    Fully parse a seed details response and return the requested fields from
+    its settings log. Missing fields are left out.
+    """
+    try:
+        settings = json.loads(json.loads(body).get('settingsLog'))
+    except (TypeError, ValueError):
+        return {}
+    return {name: settings[name] for name in names if name in settings}
 
 
 class ZSR:
@@ -68,32 +126,297 @@ class ZSR:
         'Z':'NoteZ',
     }
 
-    def __init__(self, ootr_api_key):
+    # Connection pool and timeout settings for the shared HTTP session.
+    connection_limit = 100
+    connection_limit_per_host = 10
+    connect_timeout = 10
+    read_timeout = 30
+
+    # Send preset settings gzip-compressed when rolling seeds. Only enable
+    # this if ootrandomizer.com accepts Content-Encoding: gzip bodies.
+    compress_payloads = False
+
+    retry_policy = RetryPolicy(attempts=3, base_delay=1, budget=30)
+    create_retry_policy = NonIdempotentRetryPolicy(attempts=3, base_delay=1, budget=30)
+    password_retry_policy = RetryPolicy(attempts=3, base_delay=2, budget=20)
+    no_retry_policy = RetryPolicy(attempts=1)
+
+    # Outbound rate limits for ootrandomizer.com as (requests per second,
+    # burst size), per endpoint and overall. When requests have to queue,
+    # lower priority numbers go first.
+    rate_limits = {
+        'create': (2, 5),
+        'details': (5, 10),
+        'password': (5, 10),
+        'status': (10, 10),
+        'version': (1, 5),
+        'pool_create': (1, 2),
+    }
+    global_rate_limit = (15, 20)
+    # Endpoints that hit the same API and so share a circuit breaker.
+    circuit_groups = {
+        'pool_create': 'create',
+    }
+    request_priorities = {
+        'create': 0,
+        'details': 0,
+        'password': 0,
+        'status': 1,
+        'version': 2,
+        'pool_create': 3,
+    }
+
+    def __init__(self, ootr_api_key, cache_dir=None, version_ttl=300):
         self.ootr_api_key = ootr_api_key
+        self.version_ttl = version_ttl
         self.version_map = {}
-        self.build_version_map()
-
-    def build_version_map(self):
-        for i in range(len(self.valid_versions)):
-            self.version_map[self.valid_versions[i][0]] = Branch(
-                rtgg_arg=self.valid_versions[i][0],
-                name=self.valid_versions[i][1],
-                ootr_name=self.valid_versions[i][2],
-                settings_endpoint=self.valid_versions[i][3]
+        self.disk_cache = DiskCache(cache_dir) if cache_dir else None
+        # Per-seed hash, password and final status, shared by all rooms.
+        self.seed_cache = AsyncLRUCache(max_size=1024, ttl=60 * 60 * 6)
+        self.listeners = weakref.WeakSet()
+        self.scheduler = RequestScheduler(self.rate_limits, self.request_priorities, self.global_rate_limit)
+        self.breakers = {
+            endpoint: CircuitBreaker(endpoint)
+            for endpoint in self.rate_limits if endpoint not in self.circuit_groups
+        }
+        metrics.add_collector(self.collect_metrics)
+        self._session = None
+
+    @property
+    def session(self):
+        """
+        Shared aiohttp session, created on first use.
+
+        All requests to ootrandomizer.com and GitHub go through this session
+        so connections are pooled and kept alive between calls.
+        """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.connection_limit,
+                    limit_per_host=self.connection_limit_per_host,
+                ),
+                timeout=aiohttp.ClientTimeout(
+                    connect=self.connect_timeout,
+                    sock_read=self.read_timeout,
+                ),
+                raise_for_status=True,
             )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def throttle(self, endpoint):
+        if endpoint is not None:
+            await self.scheduler.acquire(endpoint)
+
+    def breaker(self, endpoint):
+        return self.breakers.get(self.circuit_groups.get(endpoint, endpoint))
+
+    async def call(self, endpoint, request, retry_policy=None):
+        """
+        Run `request` under the endpoint's rate limit, the retry policy and
+        the endpoint's circuit breaker, recording its latency and outcome.
+
+        Raises CircuitOpenError without making a request if the endpoint has
+        been failing.
+        """
+        label = endpoint or 'other'
+        retry_policy = retry_policy or self.retry_policy
+        breaker = self.breaker(endpoint)
+
+        async def attempt():
+            # Wait for the rate limiter first, so that time spent queueing
+            # locally doesn't count as ootrandomizer.com latency.
+            await self.throttle(endpoint)
+            if breaker is None:
+                return await request()
+            breaker.before_call()
+            started = time.monotonic()
+            try:
+                result = await request()
+            except asyncio.CancelledError:
+                breaker.cancel_probe()
+                raise
+            except Exception as ex:
+                # Judge failures the same way whatever the caller's retry
+                # policy, so e.g. create timeouts still count.
+                breaker.record(self.retry_policy.is_retryable(ex), time.monotonic() - started)
+                raise
+            breaker.record(False, time.monotonic() - started)
+            return result
+
+        with metrics.timer('randobot_zsr_request_seconds', endpoint=label):
+            try:
+                result = await retry_policy.call(attempt)
+            except Exception:
+                metrics.inc('randobot_zsr_requests_total', endpoint=label, outcome='error')
+                raise
+        metrics.inc('randobot_zsr_requests_total', endpoint=label, outcome='ok')
+        return result
+
+    def timeout_kwargs(self, timeout):
+        # Passing timeout=None to aiohttp disables the session's connect and
+        # read timeouts entirely, so only pass a timeout when overriding them.
+        return {} if timeout is None else {'timeout': timeout}
+
+    async def get_json(self, url, params=None, timeout=None, retry_policy=None, endpoint=None):
+        async def request():
+            async with self.session.get(url, params=params, **self.timeout_kwargs(timeout)) as resp:
+                return await resp.json(content_type=None)
+        return await self.call(endpoint, request, retry_policy)
+
+    async def get_text(self, url, params=None, timeout=None, retry_policy=None, endpoint=None):
+        async def request():
+            async with self.session.get(url, params=params, **self.timeout_kwargs(timeout)) as resp:
+                return await resp.text()
+        return await self.call(endpoint, request, retry_policy)
+
+    def cached_json(self, url, params=None):
+        """
+        The on-disk cached copy of a JSON document, without revalidating it,
+        or None if there isn't one.
+        """
+        if self.disk_cache is None:
+            return None
+        entry = self.disk_cache.get(url, params)
+        if entry is None:
+            return None
+        try:
+            return json.loads(entry['body'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    async def get_cached_json(self, url, params=None, endpoint=None):
+        """
+        GET a JSON document, revalidating against the on-disk cache.
+
+        Sends If-None-Match/If-Modified-Since when a cached copy exists, and
+        falls back to the cached copy if the server can't be reached.
+        """
+        if self.disk_cache is None:
+            return await self.get_json(url, params=params, endpoint=endpoint)
+        entry = self.disk_cache.get(url, params)
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        async def request():
+            async with self.session.get(url, params=params, headers=headers, raise_for_status=False) as resp:
+                if resp.status == 304 and entry:
+                    return entry['body']
+                resp.raise_for_status()
+                body = await resp.text()
+                self.disk_cache.set(
+                    url, params, body,
+                    etag=resp.headers.get('ETag'),
+                    last_modified=resp.headers.get('Last-Modified'),
+                )
+                return body
+
+        try:
+            body = await self.call(endpoint, request)
+        except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError):
+            if entry is None:
+                raise
+            body = entry['body']
+        return json.loads(body)
+
+    async def post_json(self, url, data, params=None, timeout=None, retry_policy=None, headers=None, endpoint=None):
+        async def request():
+            async with self.session.post(url, data=data, params=params, **self.timeout_kwargs(timeout),
+                                         headers={'Content-Type': 'application/json', **(headers or {})}) as resp:
+                return await resp.json(content_type=None)
+        return await self.call(endpoint, request, retry_policy)
+
+    def collect_metrics(self):
+        for endpoint, stats in self.scheduler.metrics().items():
+            yield 'randobot_zsr_queue_depth', {'endpoint': endpoint}, stats['queue_depth']
+            yield 'randobot_zsr_queue_wait_avg_seconds', {'endpoint': endpoint}, stats['wait_avg']
+            yield 'randobot_zsr_queue_wait_max_seconds', {'endpoint': endpoint}, stats['wait_max']
+        for endpoint, breaker in self.breakers.items():
+            yield 'randobot_zsr_circuit_open', {'endpoint': endpoint}, int(breaker.is_open)
+
+    def encode_settings(self, settings):
+        """
+        Serialize preset settings into a ready-to-send request body.
+
+        This is done once when presets are loaded rather than on every roll.
+        """
+        body = json.dumps(settings).encode('utf-8')
+        if self.compress_payloads:
+            body = gzip.compress(body)
+        return body
+
+    def create_branches(self):
+        """
+        Set up all known branches without loading any of them.
+        """
+        for rtgg_arg, name, ootr_name, settings_endpoint in self.valid_versions:
+            if rtgg_arg not in self.version_map:
+                self.version_map[rtgg_arg] = Branch(
+                    zsr=self,
+                    rtgg_arg=rtgg_arg,
+                    name=name,
+                    ootr_name=ootr_name,
+                    settings_endpoint=settings_endpoint,
+                )
+
+    async def build_version_map(self):
+        """
+        Set up all known branches and load the stable one.
+
+        Other branches are loaded lazily on first use (see
+        `Branch.ensure_loaded`). Returns True if stable loaded successfully.
+        """
+        self.create_branches()
+        return await self.version_map['stable'].ensure_loaded()
+
+    async def refresh_branches(self):
+        """
+        Reload every branch that has been loaded so far.
+        """
+        await asyncio.gather(*(
+            branch.refresh_in_background(reload_presets=True)
+            for branch in self.version_map.values() if branch.loaded
+        ))
+
+    def add_listener(self, listener):
+        """
+        Register an object whose `branch_updated(branch, old_version)`
+        coroutine is called whenever a branch changes version.
+        """
+        self.listeners.add(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.discard(listener)
+
+    async def notify_version_change(self, branch, old_version):
+        results = await asyncio.gather(*(
+            listener.branch_updated(branch, old_version)
+            for listener in list(self.listeners)
+        ), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                capture_exception(result)
 
-    def roll_seed(self, preset, branch, encrypt, password=False):
+    async def roll_seed(self, preset, branch, encrypt, password=False, endpoint='create'):
         """
         Generate a seed and return its public URL.
+
+        `endpoint` selects the rate limit and priority the request is
+        scheduled with (see `rate_limits`).
         """
         dev = branch.rtgg_arg != 'stable'
 
-        if dev:
-            latest_version = branch.get_latest_version()
-            if latest_version != branch.version:
-                branch.update_version(latest_version)
-                branch.load_presets()
-        req_body = json.dumps(branch.presets[preset]['settings'])
+        if dev and branch.version_is_stale():
+            # Don't hold up the roll, the next one will pick up any new version.
+            branch.refresh_in_background()
+        req_body = branch.presets[preset]['body']
 
         params = {
             'key': self.ootr_api_key,
@@ -106,87 +429,208 @@ class ZSR:
             params['passwordLock'] = 'true'
         if dev:
             params['version'] = branch.ootr_name + '_' + branch.version
-        data = requests.post(self.seed_endpoint, req_body, params=params,
-                             headers={'Content-Type': 'application/json'}).json()
+        headers = {'Content-Encoding': 'gzip'} if self.compress_payloads else None
+        data = await self.post_json(
+            self.seed_endpoint, req_body,
+            params=params,
+            headers=headers,
+            retry_policy=self.create_retry_policy,
+            endpoint=endpoint,
+        )
         return data['id'], self.seed_public % data
 
-    def get_status(self, seed_id):
-        data = requests.get(self.status_endpoint, params={
+    async def get_status(self, seed_id):
+        # Only final statuses are cached, "still generating" must be rechecked.
+        return await self.seed_cache.get_or_fetch(
+            ('status', seed_id),
+            lambda: self._get_status(seed_id),
+            cache_if=lambda status: status != 0,
+        )
+
+    async def _get_status(self, seed_id):
+        data = await self.get_json(self.status_endpoint, params={
             'id': seed_id,
             'key': self.ootr_api_key,
-        }).json()
+        }, endpoint='status')
         return data['status']
 
-    def get_hash(self, seed_id):
-        data = requests.get(self.details_endpoint, params={
+    async def get_hash(self, seed_id):
+        return await self.seed_cache.get_or_fetch(('hash', seed_id), lambda: self._get_hash(seed_id))
+
+    async def _get_hash(self, seed_id):
+        body = await self.get_text(self.details_endpoint, params={
             'id': seed_id,
             'key': self.ootr_api_key,
-        }).json()
-        try:
-            settings = json.loads(data.get('settingsLog'))
-        except ValueError:
+        }, endpoint='details')
+        file_hash = extract_settings_log_field(body, 'file_hash')
+        if not isinstance(file_hash, list):
+            # Couldn't pick it out of the raw body, do a full parse off the event loop.
+            loop = asyncio.get_running_loop()
+            file_hash = (await loop.run_in_executor(None, parse_settings_log, body, ('file_hash',))).get('file_hash')
+        if file_hash is None:
             return None
         return ' '.join(
             self.hash_map.get(item, item)
-            for item in settings['file_hash']
+            for item in file_hash
         )
 
-    def get_password(self, seed_id, retries=3, delay=2):
+    async def get_password(self, seed_id):
         """
         Grab password for seed with active password.
 
-        Tries to retrieve the password a specified number of times,
-        with a delay between attempts. Returns None if unsuccessful.
+        Retries with backoff (see `password_retry_policy`) while the password
+        is unavailable. Returns None if unsuccessful.
         """
-        for attempt in range(retries):
-            try:
-                data = requests.get(self.password_endpoint, params={
-                    'id': seed_id,
-                    'key': self.ootr_api_key,
-                }, timeout=5)
-
-                data.raise_for_status()
+        return await self.seed_cache.get_or_fetch(('password', seed_id), lambda: self._get_password(seed_id))
 
-                password_notes = data.json().get('pw')
+    async def _get_password(self, seed_id):
+        async def request():
+            data = await self.get_json(self.password_endpoint, params={
+                'id': seed_id,
+                'key': self.ootr_api_key,
+            }, timeout=aiohttp.ClientTimeout(total=5), retry_policy=self.no_retry_policy, endpoint='password')
+            password_notes = data.get('pw')
+            if not password_notes:
+                raise RetryableError('Password not available for seed %s' % seed_id)
+            return ' '.join(
+                self.notes_map.get(item, item)
+                for item in password_notes
+            )
 
-                return ' '.join(
-                    self.notes_map.get(item, item)
-                    for item in password_notes
-                )
-            except (TypeError, ValueError, requests.RequestException):
-                if attempt < retries - 1:
-                    time.sleep(delay)
-                else:
-                    return None
+        try:
+            return await self.password_retry_policy.call(request)
+        except (TypeError, ValueError, RetryableError, CircuitOpenError, aiohttp.ClientError, asyncio.TimeoutError):
+            return None
 
 
 class Branch:
-    def __init__(self, rtgg_arg, name, ootr_name, settings_endpoint):
+    def __init__(self, zsr, rtgg_arg, name, ootr_name, settings_endpoint):
+        self.zsr = zsr
         self.rtgg_arg = rtgg_arg
         self.name = name
         self.ootr_name = ootr_name
         self.settings_endpoint = settings_endpoint
-        self.version = self.get_latest_version()
-        self.presets = self.load_presets()
+        self.version = None
+        self.presets = {}
+        self.version_checked_at = None
+        self._load_task = None
+        self._refresh_task = None
+
+    @property
+    def presets(self):
+        return self._presets
+
+    @presets.setter
+    def presets(self, presets):
+        self._presets = presets
+        # Anything computed from the presets (e.g. chat actions) is stale now.
+        self.derived = {}
+
+    @property
+    def loaded(self):
+        return self.version is not None
+
+    async def ensure_loaded(self):
+        """
+        Load this branch if it hasn't been loaded yet.
 
-    def load_presets(self):
-        settings = requests.get(self.settings_endpoint).json()
+        Concurrent callers share a single load. Returns True if the branch is
+        available, False if loading failed (it will be retried next time).
+        """
+        if self.loaded:
+            return True
+        if self._load_task is None or self._load_task.done():
+            self._load_task = detached_task(self.load())
+        try:
+            await asyncio.shield(self._load_task)
+        except Exception:
+            return False
+        return True
+
+    async def load(self):
+        """
+        Fetch the latest version and presets for this branch concurrently.
+
+        If both are in the on-disk cache, they are used straight away and
+        revalidated by a background refresh, so a restart doesn't wait on
+        the network.
+        """
+        version_data = self.zsr.cached_json(self.zsr.version_endpoint, params=self.version_params)
+        settings = self.zsr.cached_json(self.settings_endpoint)
+        if version_data is not None and settings is not None:
+            self.version = version_data['currentlyActiveVersion']
+            self.presets = self.parse_presets(settings)
+            self.refresh_in_background(reload_presets=True)
+            return
+        self.version, self.presets = await asyncio.gather(
+            self.get_latest_version(),
+            self.load_presets(),
+        )
+        self.version_checked_at = asyncio.get_running_loop().time()
 
+    def version_is_stale(self):
+        if self.version_checked_at is None:
+            return True
+        return asyncio.get_running_loop().time() - self.version_checked_at >= self.zsr.version_ttl
+
+    async def refresh(self, reload_presets=False):
+        """
+        Check for a new version, reloading presets if it has changed (or
+        always, if `reload_presets` is set).
+
+        The new presets are built in full before being swapped in together
+        with the version, so readers never see a partially loaded branch.
+        """
+        latest_version = await self.get_latest_version()
+        self.version_checked_at = asyncio.get_running_loop().time()
+        if latest_version == self.version and not reload_presets:
+            return
+        presets = await self.load_presets()
+        old_version = self.version
+        self.update_version(latest_version)
+        self.presets = presets
+        if latest_version != old_version:
+            await self.zsr.notify_version_change(self, old_version)
+
+    def refresh_in_background(self, reload_presets=False):
+        """
+        Start a refresh unless one is already in flight.
+        """
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = detached_task(self._refresh(reload_presets))
+        return self._refresh_task
+
+    async def _refresh(self, reload_presets):
+        try:
+            await self.refresh(reload_presets)
+        except Exception as ex:
+            capture_exception(ex)
+
+    async def load_presets(self):
+        return self.parse_presets(await self.zsr.get_cached_json(self.settings_endpoint))
+
+    def parse_presets(self, settings):
+        # Only the serialized body is kept, the settings dicts aren't needed
+        # once it has been built.
         return {
             min(settings[preset]['aliases'], key=len): {
                 'full_name': preset,
-                'settings': settings.get(preset),
+                'body': self.zsr.encode_settings(settings[preset]),
             }
             for preset in settings if 'aliases' in settings[preset]
         }
-    
-    def get_latest_version(self):
+
+    @property
+    def version_params(self):
+        return {'branch': self.ootr_name}
+
+    async def get_latest_version(self):
         """
         Fetch the latest version of the supplied randomizer branch.
         """
-        version_req = requests.get(ZSR.version_endpoint, params={'branch': self.ootr_name}).json()
+        version_req = await self.zsr.get_cached_json(self.zsr.version_endpoint, params=self.version_params, endpoint='version')
         latest_version = version_req['currentlyActiveVersion']
         return latest_version
-    
+
     def update_version(self, version):
         self.version = version
@@ -19,6 +19,7 @@ setup(
     },
     version='1.0.0',
     install_requires=[
+        'aiohttp>=3.7,<4.0',
         'gql[aiohttp]>=3.4.0,<4.0',
         'isodate>=0.6.1,<0.7',
         'racetime_bot>=1.5.0,<3.0',